@@ -3,8 +3,6 @@ from __future__ import annotations
 import hashlib
 import json
 import os
-import tempfile
-from contextlib import closing
 from typing import TYPE_CHECKING
 
 import e3.log
@@ -247,15 +245,11 @@ class CheckoutManager:
             shallow = "git_shallow_fetch" in os.environ.get(
                 "E3_ENABLE_FEATURE", ""
             ).split(",") and (not self.compute_changelog or not old_commit)
-            g.git_cmd(
-                [
-                    "fetch",
-                    "-f",
-                    "--depth=1" if shallow else None,
-                    remote_name,
-                    f"{revision}:refs/e3-checkout",
-                ]
-            )
+            fetch_cmd = ["fetch", "-f"]
+            if shallow:
+                fetch_cmd.append("--depth=1")
+            fetch_cmd += [remote_name, f"{revision}:refs/e3-checkout"]
+            g.git_cmd(fetch_cmd)
 
             g.checkout("refs/e3-checkout", force=True)
             new_commit = g.rev_parse()
@@ -277,14 +271,11 @@ class CheckoutManager:
             )
             if self.compute_changelog:
                 # Fetch the change log and dump it into the changelog file
-                with closing(tempfile.NamedTemporaryFile(mode="w", delete=False)) as fd:
-                    g.write_log(fd, rev_range=f"{old_commit}..{new_commit}")
-                    tmp_filename = fd.name
-                try:
-                    with open(tmp_filename) as fd:
-                        commits = list(g.parse_log(fd, max_diff_size=1024))
-                finally:
-                    rm(tmp_filename)
+                commits = list(
+                    g.iter_log(
+                        rev_range=f"{old_commit}..{new_commit}", max_diff_size=1024
+                    )
+                )
 
                 with open(self.changelog_file, "w") as fd:
                     json.dump(commits, fd)
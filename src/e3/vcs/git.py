@@ -6,22 +6,19 @@ Example::
     g = GitRepository(working_tree='/tmp/e3-core')
     g.init()
     g.update('ssh://git.adacore.com/anod', refspec='master', force=True)
-    with open('/tmp/e3-core-log', 'w') as fd:
-        g.write_log(fd, max_count=10)
-    with open('/tmp/e3-core-log') as fd:
-        authors = []
-        for commit in g.parse_log(fd, max_diff_size=1024):
-            authors.append(commit['email'])
+    authors = []
+    for commit in g.iter_log(max_count=10, max_diff_size=1024):
+        authors.append(commit['email'])
 """
 
 
 from __future__ import annotations
 
-import itertools
 import os
+import queue
+import re
 import sys
-import tempfile
-from contextlib import closing
+import threading
 from typing import TYPE_CHECKING
 
 import e3.fs
@@ -29,9 +26,17 @@ import e3.log
 import e3.os.fs
 import e3.os.process
 from e3.os.process import PIPE
-from e3.text import bytes_as_str
 from e3.vcs import VCSError
 
+# Use libgit2 through pygit2 when available to avoid spawning git for simple
+# queries (see GitRepository._libgit2)
+try:
+    import pygit2
+
+    has_pygit2 = True
+except ImportError:
+    has_pygit2 = False
+
 if TYPE_CHECKING:
     from typing import (
         Any,
@@ -39,13 +44,12 @@ if TYPE_CHECKING:
         IO,
         Literal,
         List,
-        Optional,
         TextIO,
     )
     from collections.abc import Iterator
     from e3.os.process import Run, DEVNULL_VALUE, PIPE_VALUE
 
-    Git_Cmd = List[Optional[str]]
+    Git_Cmd = List[str]
     GIT_LOG_STREAM_VALUE = Literal[-4]
 
 # Special value to direct outputs to the git log stream
@@ -57,20 +61,188 @@ logger = e3.log.getLogger("vcs.git")
 HEAD: Final = "HEAD"
 FETCH_HEAD: Final = "FETCH_HEAD"
 
+# Path to the git binary, see _git_bin
+_GIT_BIN: str | None = None
+
+# Log format used by write_log and iter_log:
+#   %H: commit hash
+#   %aE: author email respecting .mailmap
+#   %ci: committer date, ISO 8601-like format (don't use %cI)
+#   %n: new line
+#   %B: raw body (unwrapped subject and body)
+#   %N: commit notes
+_LOG_FORMAT: Final = "--format=format:%H%n%aE%n%ci%n%n%B"
+_LOG_NOTES_FORMAT: Final = "--format=format:%H%n%aE%n%ci%n%N%n%n%B"
+
+# Command used to get the diff of commits
+_DIFF_TREE_CMD: Final = ("--no-pager", "diff-tree", "--cc", "--no-commit-id", "--root")
+
+# Header of each commit in the output of git log --log-size
+_LOG_SIZE_HEADER = b"log size "
+_LOG_SIZE_RE = re.compile(rb"\n?log size (\d+)\n")
+
+# Size of the chunks read when parsing git log output
+_LOG_CHUNK_SIZE = 1 << 16
+
+# Max number of commits whose diff is computed in advance by parse_log
+_PREFETCH_SIZE = 64
+
+# Full sha1 object name
+_SHA1_RE = re.compile("[0-9a-f]{40}")
+
+# Size requested for the pipes reading git output, see _enlarge_pipe
+_PIPE_SIZE = 1 << 20
+
 
 # Implementation note: some git commands can produce a big amount of data (e.g.
-# git diff or git log). We always redirect git command result to a file then
-# parse it, limiting the size of data read to avoid crashing our program.
+# git diff or git log). Their output is either redirected to a file or read
+# directly from a pipe by bounded chunks, always limiting the size of data
+# kept in memory to avoid crashing our program.
 
 
 class GitError(VCSError):
     pass
 
 
+def _git_bin() -> str:
+    """Return the path to the git binary.
+
+    The lookup is done only once, its result is cached in _GIT_BIN.
+
+    :raise: GitError
+    """
+    global _GIT_BIN
+    if _GIT_BIN is None:
+        git_binary = e3.os.process.which("git", default=None)
+        if git_binary is None:  # defensive code
+            raise GitError("cannot find git", "git_cmd")
+        _GIT_BIN = e3.os.fs.unixpath(git_binary)
+    return _GIT_BIN
+
+
+def _utf8_truncate(content: bytes, size: int) -> bytes:
+    """Truncate utf-8 content without splitting a multi-byte character.
+
+    :param content: utf-8 encoded content
+    :param size: maximum size of the result in bytes
+    :return: the longest prefix of content not exceeding size bytes and not
+        ending with an incomplete utf-8 sequence
+    """
+    end = size
+    # A utf-8 sequence is at most 4 bytes long: if content[end] is a
+    # continuation byte (0b10xxxxxx) back off to the start of the character
+    while end > 0 and size - end < 3 and content[end] & 0xC0 == 0x80:
+        end -= 1
+    return content[:end]
+
+
+def _enlarge_pipe(pipe: IO[bytes]) -> None:
+    """Enlarge the kernel buffer of a pipe.
+
+    The default size (64KiB) makes git block frequently when it produces a
+    large output, a bigger buffer lets it write ahead while we parse. This
+    is only supported on Linux, the function does nothing elsewhere.
+
+    :param pipe: read end of a pipe
+    """
+    if sys.platform == "linux":
+        import fcntl
+
+        try:
+            # F_SETPIPE_SZ is only defined by fcntl since Python 3.10
+            fcntl.fcntl(pipe.fileno(), getattr(fcntl, "F_SETPIPE_SZ", 1031), _PIPE_SIZE)
+        except OSError:
+            # The size may exceed /proc/sys/fs/pipe-max-size for unprivileged
+            # users, keep the default size in that case
+            pass
+
+
+class _DiffBatch:
+    """Compute commit diffs with a single ``git diff-tree --stdin`` process.
+
+    The process is spawned on the first call to ``diff`` and then kept alive
+    until ``close`` is called, avoiding one fork/exec per commit. Each commit
+    is sent on the process standard input followed by a sentinel line: git
+    echoes verbatim (and flushes) lines that are not object names, thus the
+    sentinel marks the end of the diff in the process output.
+    """
+
+    # Diff lines always start with a space, +, -, @, \\ or a diff header
+    # keyword so the sentinel cannot be mistaken for diff content.
+    SENTINEL: Final = b"e3-diff-end\n"
+
+    def __init__(self, repo: GitRepository):
+        """Initialize a _DiffBatch.
+
+        :param repo: the repository containing the commits
+        """
+        self.repo = repo
+        self.process: Run | None = None
+
+    def diff(self, commit: str, max_size: int) -> tuple[bytes, int]:
+        """Get the diff of a commit.
+
+        :param commit: sha1 of a commit
+        :param max_size: max number of bytes of the diff to return
+        :return: a tuple (content, size) where content is the diff truncated
+            to max_size bytes and size the size of the complete diff. Note
+            that the complete diff is still read from the pipe (git cannot
+            be told to stop in the middle of a diff) but only max_size bytes
+            of it are kept, other bytes being read by bounded chunks and
+            discarded.
+        :raise: GitError
+        """
+        if self.process is None:
+            # An input starting with "|" gives access to the process
+            # standard input through a pipe
+            self.process = self.repo.git_cmd(
+                [*_DIFF_TREE_CMD, "--stdin"],
+                input="|",
+                output=PIPE,
+                error=self.repo.log_stream,
+                bg=True,
+            )
+            _enlarge_pipe(self.process.internal.stdout)
+        stdin = self.process.internal.stdin
+        stdout = self.process.internal.stdout
+        stdin.write(commit.encode("utf-8") + b"\n" + self.SENTINEL)
+        stdin.flush()
+
+        content = bytearray()
+        size = 0
+        # Read lines by chunks of bounded size so that long lines are never
+        # loaded entirely in memory. The sentinel can only be found at the
+        # beginning of a line.
+        line_start = True
+        while True:
+            chunk = stdout.readline(_LOG_CHUNK_SIZE)
+            if not chunk:
+                raise GitError(
+                    f"cannot get diff of {commit}",
+                    origin="parse_log",
+                    process=self.process,
+                )
+            if line_start and chunk == self.SENTINEL:
+                break
+            line_start = chunk.endswith(b"\n")
+            # The whole diff has to be read but only keep max_size bytes
+            if size < max_size:
+                content += memoryview(chunk)[: max_size - size]
+            size += len(chunk)
+        return bytes(content), size
+
+    def close(self) -> None:
+        """Terminate the git process."""
+        if self.process is not None:
+            self.process.wait()
+            self.process = None
+
+
 class GitRepository:
     """Interface to a Git Repository.
 
-    :cvar git: path to the git binary
+    :cvar git: path to the git binary, if None (default) git is looked up
+        in the PATH
     :cvar log_stream: stream where the log commands will be redirected
         (default is stdout)
     :ivar working_tree: path to the git working tree
@@ -85,6 +257,12 @@ class GitRepository:
         :param working_tree: working tree of the GitRepository
         """
         self.working_tree = working_tree
+        # (url, refspec) fetched by this instance, see fetch use_cache
+        self._fetched: set[tuple[str, str | None]] = set()
+        # pygit2 repository, see _libgit2
+        self._libgit2_repo: Any = None
+        # refspec -> sha1 computed by rev_parse since the last git command
+        self._rev_cache: dict[str, str] = {}
 
     @classmethod
     def create(cls, repo_path: str, initial_content_path: str | None = None) -> str:
@@ -101,9 +279,19 @@ class GitRepository:
         if initial_content_path is not None:
             e3.fs.sync_tree(initial_content_path, repo_path, ignore=[".git"])
             repo.git_cmd(["add", "-A"])
-            repo.git_cmd(["config", "user.email", "e3-core@example.net"])
-            repo.git_cmd(["config", "user.name", "e3 core"])
-            repo.git_cmd(["commit", "-m", "initial content"])
+            # Pass the identity on the command line rather than spawning git
+            # config twice
+            repo.git_cmd(
+                [
+                    "-c",
+                    "user.email=e3-core@example.net",
+                    "-c",
+                    "user.name=e3 core",
+                    "commit",
+                    "-m",
+                    "initial content",
+                ]
+            )
         return repo_path
 
     def git_cmd(
@@ -119,25 +307,43 @@ class GitRepository:
     ) -> Run:
         """Run a git command.
 
-        :param cmd: the command line as a list of string, all None entries will
-            be discarded
+        :param cmd: the command line as a list of string, None entries are
+            not allowed
         :param output: see e3.os.process.Run, by default it is the
             ``log_stream`` class attribute.
+        :param kwargs: additional arguments passed to e3.os.process.Run. Note
+            that when ``bg`` is True the exit status is not checked.
         """
-        if self.__class__.git is None:
-            git_binary = e3.os.process.which("git", default=None)
-            if git_binary is None:  # defensive code
-                raise GitError("cannot find git", "git_cmd")
-            self.__class__.git = e3.os.fs.unixpath(git_binary)
+        # The command may update references, invalidate rev_parse results
+        self._rev_cache.clear()
+        return self._run_git(cmd, output=output, **kwargs)
 
+    def _run_git(
+        self,
+        cmd: Git_Cmd,
+        output: DEVNULL_VALUE
+        | PIPE_VALUE
+        | GIT_LOG_STREAM_VALUE
+        | str
+        | IO
+        | None = GIT_LOG_STREAM,
+        **kwargs: Any,
+    ) -> Run:
+        """Run a git command without invalidating rev_parse results.
+
+        Only for commands that cannot update references, see git_cmd.
+        """
         if output == GIT_LOG_STREAM:
             output = self.log_stream
 
-        p_cmd = [arg for arg in cmd if arg is not None]
-        p_cmd.insert(0, self.__class__.git)
+        # None entries used to be silently discarded, report them clearly
+        if None in cmd:
+            raise GitError(f"invalid git command line: {cmd}", origin="git_cmd")
+
+        p_cmd = [self.git or _git_bin(), *cmd]
 
         p = e3.os.process.Run(p_cmd, cwd=self.working_tree, output=output, **kwargs)
-        if p.status != 0:
+        if p.status is not None and p.status != 0:
             raise GitError(
                 "{} failed (exit status: {})".format(
                     e3.os.process.command_line_image(p_cmd), p.status
@@ -157,6 +363,8 @@ class GitRepository:
         """
         e3.fs.mkdir(self.working_tree)
         self.git_cmd(["init", "-q"])
+        self._fetched.clear()
+        self._libgit2_repo = None
 
         # Git version 1.8.3.1 might crash when calling "git stash" when
         # .git/logs/refs is not created. Recent versions of git do not
@@ -164,7 +372,11 @@ class GitRepository:
         e3.fs.mkdir(os.path.join(self.working_tree, ".git", "logs", "refs"))
 
         if url is not None:
-            self.git_cmd(["remote", "add", remote, url])
+            cmd: Git_Cmd = ["remote", "add"]
+            if remote is not None:
+                cmd.append(remote)
+            cmd.append(url)
+            self.git_cmd(cmd)
 
     def checkout(self, branch: str, force: bool = False) -> None:
         """Checkout a given refspec.
@@ -173,9 +385,27 @@ class GitRepository:
         :param force: throw away local changes if needed
         :raise: GitError
         """
-        cmd = ["checkout", "-q", "-f" if force else None, branch]
+        cmd: Git_Cmd = ["checkout", "-q"]
+        if force:
+            cmd.append("-f")
+        cmd.append(branch)
         self.git_cmd(cmd)
 
+    @property
+    def _libgit2(self) -> Any:
+        """Return the pygit2 Repository of the working tree.
+
+        :return: a pygit2.Repository object or None if pygit2 is not
+            available or cannot open the repository. In that case the git
+            command line is used instead.
+        """
+        if self._libgit2_repo is None and has_pygit2:
+            try:
+                self._libgit2_repo = pygit2.Repository(self.working_tree)
+            except pygit2.GitError:
+                e3.log.debug("cannot open %s with pygit2", self.working_tree)
+        return self._libgit2_repo
+
     def describe(self, commit: str = HEAD) -> str:
         """Get a human friendly revision for the given refspec.
 
@@ -205,44 +435,92 @@ class GitRepository:
         :param stream: an open file descriptor
         :raise: GitError
         """
-        cmd: Git_Cmd = [
-            "--no-pager",
-            "diff-tree",
-            "--cc",
-            "--no-commit-id",
-            "--root",
-            commit,
-        ]
+        cmd: Git_Cmd = [*_DIFF_TREE_CMD, commit]
         self.git_cmd(cmd, output=stream, error=self.log_stream)
 
-    def fetch(self, url: str, refspec: str | None = None) -> None:
+    def fetch(
+        self, url: str, refspec: str | None = None, use_cache: bool = False
+    ) -> None:
         """Fetch remote changes.
 
         :param url: url of the remote repository
         :param refspec: specifies which refs to fetch and which local refs to
             update.
+        :param use_cache: if True, do nothing when the same url and refspec
+            have already been fetched by this object. Only use it when
+            changes done on the remote since the previous fetch can be
+            ignored.
         :raise: GitError
         """
-        self.git_cmd(["fetch", url, refspec])
+        if use_cache and (url, refspec) in self._fetched:
+            return
+        cmd: Git_Cmd = ["fetch", url]
+        if refspec is not None:
+            cmd.append(refspec)
+        self.git_cmd(cmd)
+        self._fetched.add((url, refspec))
 
-    def update(self, url: str, refspec: str, force: bool = False) -> None:
+    def update(
+        self, url: str, refspec: str, force: bool = False, probe: bool = False
+    ) -> None:
         """Fetch remote changes and checkout FETCH_HEAD.
 
+        By default no check is done before fetching: an unreachable remote
+        or an unknown refspec is reported by the fetch itself, so callers
+        should catch GitError rather than validate the remote beforehand.
+
         :param url: url of the remote repository
         :param refspec: specifies which refs to fetch and which local refs to
             update.
         :param force: throw away local changes if needed
+        :param probe: if True, check with ``git ls-remote`` that the source
+            of refspec, which must then be a ref name, exists on the remote
+            before fetching. This costs an extra round-trip to the remote.
         :raise: GitError
         """
+        if probe:
+            # Strip the leading + of a forced update: it is not a ref name
+            src = refspec.split(":", 1)[0].lstrip("+")
+            self.git_cmd(["ls-remote", "--exit-code", url, src], output=PIPE)
         self.fetch(url, refspec)
         self.checkout("FETCH_HEAD", force=force)
 
-    def fetch_gerrit_notes(self, url: str) -> None:
+    def fetch_gerrit_notes(self, url: str, use_cache: bool = False) -> None:
         """Fetch notes generated by Gerrit in `refs/notes/review`.
 
         :param url: url of the remote repository
+        :param use_cache: if True, do not fetch again notes already fetched
+            by this object (see fetch)
         """
-        self.fetch(url, "refs/notes/review:refs/notes/review")
+        self.fetch(url, "refs/notes/review:refs/notes/review", use_cache=use_cache)
+
+    def _log_cmd(
+        self,
+        max_count: int = 50,
+        rev_range: str | None = None,
+        with_gerrit_notes: bool = False,
+        nul_separated: bool = False,
+    ) -> Git_Cmd:
+        """Return the git log command used by write_log and iter_log.
+
+        See write_log for a description of the parameters.
+
+        :param nul_separated: if True separate commits with NUL characters
+            rather than prefixing each commit with its size. This saves git
+            the computation of the size of each commit.
+        """
+        cmd: Git_Cmd = [
+            "log",
+            _LOG_NOTES_FORMAT if with_gerrit_notes else _LOG_FORMAT,
+            "-z" if nul_separated else "--log-size",
+        ]
+        if max_count:
+            cmd.append(f"--max-count={max_count}")
+        if with_gerrit_notes:
+            cmd.append("--show-notes=review")
+        if rev_range is not None:
+            cmd.append(rev_range)
+        return cmd
 
     def write_log(
         self,
@@ -253,6 +531,10 @@ class GitRepository:
     ) -> None:
         """Write formatted log to a stream.
 
+        Note that when the log is only written to be parsed afterward with
+        parse_log, iter_log should be preferred as it avoids storing the
+        complete log.
+
         :param stream: an open stream where to write the log content
         :param max_count: max number of commit to display
         :param rev_range: git revision range, see ``git log -h`` for details
@@ -260,113 +542,293 @@ class GitRepository:
             review data such as Submitted-at, Submitted-by.
         :raise: GitError
         """
-        # Format:
-        #   %H: commit hash
-        #   %aE: author email respecting .mailmap
-        #   %ci: committer date, ISO 8601-like format (don't use %cI)
-        #   %n: new line
-        #   %B: raw body (unwrapped subject and body)
-        #   %N: commit notes
-        cmd: Git_Cmd = [
-            "log",
-            "--format=format:%H%n%aE%n%ci%n"
-            + ("%N%n" if with_gerrit_notes else "")
-            + "%n%B",
-            "--log-size",
-            "--max-count=%d" % max_count if max_count else None,
-            "--show-notes=review" if with_gerrit_notes else None,
-            rev_range,
-        ]
+        cmd = self._log_cmd(
+            max_count=max_count,
+            rev_range=rev_range,
+            with_gerrit_notes=with_gerrit_notes,
+        )
         self.git_cmd(cmd, output=stream, error=None)
 
+    def iter_log(
+        self,
+        max_count: int = 50,
+        rev_range: str | None = None,
+        with_gerrit_notes: bool = False,
+        max_diff_size: int = 0,
+        max_message_size: int = 0,
+    ) -> Iterator[dict[str, str | dict]]:
+        """Iterate over the commits of the log.
+
+        The output of ``git log`` is parsed while it is produced, so neither
+        the complete log nor a temporary file is needed.
+
+        :param max_count: max number of commit to display
+        :param rev_range: git revision range, see ``git log -h`` for details
+        :param with_gerrit_notes: if True also fetch Gerrit notes containing
+            review data such as Submitted-at, Submitted-by.
+        :param max_diff_size: max size of a diff, if <= 0 diff are ignored
+        :param max_message_size: max size of a commit message in bytes, if
+            <= 0 messages are not truncated
+        :return: a generator returning commit information, see parse_log.
+            git is killed when the generator is closed before the end of the
+            log, e.g. when the caller breaks out of the iteration.
+        :raise: GitError
+        """
+        cmd = self._log_cmd(
+            max_count=max_count,
+            rev_range=rev_range,
+            with_gerrit_notes=with_gerrit_notes,
+            nul_separated=True,
+        )
+        p = self.git_cmd(cmd, output=PIPE, error=None, bg=True)
+        _enlarge_pipe(p.internal.stdout)
+        complete = False
+        try:
+            yield from self.parse_log(
+                p.internal.stdout,
+                max_diff_size=max_diff_size,
+                max_message_size=max_message_size,
+            )
+            complete = True
+        finally:
+            if not complete:
+                # The iteration stopped before the end of the log (the caller
+                # has enough commits or an error occurred): do not let git
+                # walk the rest of the history.
+                p.kill(recursive=False)
+            p.wait()
+
+        if p.status != 0:
+            raise GitError(
+                "{} failed (exit status: {})".format(p.command_line_image(), p.status),
+                origin="iter_log",
+                process=p,
+            )
+
     def parse_log(
-        self, stream: IO[str], max_diff_size: int = 0
+        self,
+        stream: IO[str] | IO[bytes],
+        max_diff_size: int = 0,
+        max_message_size: int = 0,
     ) -> Iterator[dict[str, str | dict]]:
         """Parse a log stream generated with `write_log`.
 
-        :param stream: stream of text to read
+        Logs generated with ``git log -z`` instead of ``--log-size`` are also
+        supported, the format being detected automatically.
+
+        See also iter_log that runs ``git log`` and parses its output on the
+        fly.
+
+        :param stream: stream to read, its file descriptor is used directly
+            when available
         :param max_diff_size: max size of a diff, if <= 0 diff are ignored
+        :param max_message_size: max size of a commit message in bytes,
+            longer messages are truncated. If <= 0 messages are kept entirely.
         :return: a generator returning commit information (directories with
             the following keys: sha, email, date, notes, message, diff). Note
             that the key diff is only set when max_diff_size is bigger than 0.
             The notes value is a dictionary built from the 'key:value' found in
-            Gerrit notes.
+            Gerrit notes, other lines are ignored (None if no such line is
+            found).
         """
 
-        def to_commit(object_content: str) -> dict:
+        def to_commit(object_content: bytes) -> dict:
             """Return commit information."""
-            headers, body = object_content.split("\n\n", 1)
+            # Split and truncate the content before decoding it so that only
+            # the bytes actually returned are decoded. Content is not always
+            # in utf-8 format thus escape invalid bytes.
+            headers, _, body = object_content.partition(b"\n\n")
 
             # Retrieve sha, email, date, and (optionally) notes if some notes
             # are attached to the commit
-            result = dict(
-                itertools.zip_longest(
-                    ("sha", "email", "date", "notes"),
-                    headers.replace("\r", "").split("\n", 3),
-                )
+            parts = (
+                headers.replace(b"\r", b"")
+                .decode("utf-8", errors="backslashreplace")
+                .split("\n", 3)
             )
-
-            # replace notes "key: value" lines by a dictionary
+            result: dict[str, Any] = {
+                "sha": parts[0],
+                "email": parts[1],
+                "date": parts[2],
+                "notes": parts[3] if len(parts) > 3 else None,
+            }
+
+            # replace notes "key: value" lines by a dictionary, discarding
+            # lines not following that format
             if result["notes"]:
-                try:
-                    result["notes"] = dict(
-                        notes_line.split(": ", 1)
-                        for notes_line in result["notes"].splitlines()
+                notes = {}
+                for notes_line in result["notes"].splitlines():
+                    key, sep, value = notes_line.partition(": ")
+                    if sep:
+                        notes[key] = value
+                result["notes"] = notes or None
+
+            if 0 < max_message_size < len(body):
+                result["message"] = (
+                    _utf8_truncate(body, max_message_size).decode(
+                        "utf-8", errors="backslashreplace"
                     )
-                except ValueError:
-                    # Notes format invalid, discard it
-                    result["notes"] = None
-
-            result["message"] = body
+                    + "\n... message too long ...\n"
+                )
+            else:
+                result["message"] = body.decode("utf-8", errors="backslashreplace")
 
             if max_diff_size > 0:
-                tempfile_name = None
-                try:
-                    with closing(
-                        tempfile.NamedTemporaryFile(mode="wb", delete=False)
-                    ) as diff_fd:
-                        tempfile_name = diff_fd.name
-                        self.write_diff(diff_fd, result["sha"])
-
-                        # compute file size
-                        diff_fd.seek(0, 2)
-                        diff_size = diff_fd.tell()
-                        e3.log.debug("diff size for %s: %d", result["sha"], diff_size)
-
-                    with open(tempfile_name, "rb") as f:
-                        content = f.read(max_diff_size)
-
-                        # Diff content is not always in utf-8 format thus use
-                        # a safe function to decode it.
-                        result["diff"] = bytes_as_str(content)
-
-                    if diff_size > max_diff_size:
-                        result["diff"] += "\n... diff too long ...\n"
-                finally:
-                    if tempfile_name is not None:
-                        e3.fs.rm(tempfile_name)
+                content, diff_size = diff_batch.diff(result["sha"], max_diff_size)
+                e3.log.debug("diff size for %s: %d", result["sha"], diff_size)
+
+                # Diff content is not always in utf-8 format (and truncation
+                # may split a character) thus escape invalid bytes.
+                result["diff"] = content.decode("utf-8", errors="backslashreplace")
+
+                if diff_size > max_diff_size:
+                    result["diff"] += "\n... diff too long ...\n"
 
             return result
 
-        size_to_read = 0
-        while True:
-            line = stream.readline()
-            if not line.strip():
-                # Strip empty line separating two commits
-                line = stream.readline()
-            if line.startswith("log size "):
-                size_to_read = int(line.rsplit(None, 1)[1])
-                # Get commit info
-            if size_to_read <= 0:
-                return
-            yield to_commit(stream.read(size_to_read))
-            size_to_read = 0
+        # Read the stream directly from its file descriptor when possible to
+        # avoid going through Python buffering and decoding layers
+        try:
+            fd: int | None = stream.fileno()
+        except (AttributeError, OSError):
+            # io.UnsupportedOperation is raised by in-memory streams
+            fd = None
+
+        def read_chunk() -> bytes:
+            """Read the next chunk of the log."""
+            if fd is not None:
+                return os.read(fd, _LOG_CHUNK_SIZE)
+            data = stream.read(_LOG_CHUNK_SIZE)
+            # Log sizes are expressed in bytes so work on bytes
+            return data.encode("utf-8") if isinstance(data, str) else data
+
+        def read_objects() -> Iterator[bytes]:
+            """Yield the raw content of each commit found in the log."""
+            buf = bytearray()
+            pos = 0
+            # Position from which to look for the next NUL separator
+            scan = 0
+            eof = False
+
+            # Logs written by write_log start with a "log size" header, other
+            # logs (see iter_log) use NUL characters to separate commits
+            while len(buf) < len(_LOG_SIZE_HEADER) and not eof:
+                chunk = read_chunk()
+                eof = not chunk
+                buf += chunk
+            nul_separated = not buf.startswith(_LOG_SIZE_HEADER)
+
+            while True:
+                if nul_separated:
+                    end = buf.find(b"\0", scan)
+                    if end != -1:
+                        yield bytes(memoryview(buf)[pos:end])
+                        pos = scan = end + 1
+                        continue
+                    if eof:
+                        if pos < len(buf):
+                            yield bytes(memoryview(buf)[pos:])
+                        return
+                    scan = len(buf)
+                else:
+                    # Each commit is introduced by a "log size <size>" line,
+                    # separated from the previous commit by an empty line
+                    m = _LOG_SIZE_RE.match(buf, pos)
+                    if m is not None:
+                        start = m.end()
+                        end = start + int(m.group(1))
+                        if end <= len(buf):
+                            yield bytes(memoryview(buf)[start:end])
+                            pos = end
+                            continue
+                    if eof:
+                        return
+
+                # Not enough data to get the next commit: discard the content
+                # already parsed and read more
+                del buf[:pos]
+                scan -= pos
+                pos = 0
+                chunk = read_chunk()
+                eof = not chunk
+                buf += chunk
+
+        diff_batch = _DiffBatch(self)
+        if max_diff_size <= 0:
+            for object_content in read_objects():
+                yield to_commit(object_content)
+            return
+
+        # Computing diffs requires a round-trip with git for each commit: do
+        # it in a separate thread so that it overlaps with the processing of
+        # the commits already returned.
+        commits: queue.Queue[dict | None] = queue.Queue(maxsize=_PREFETCH_SIZE)
+        errors: list[Exception] = []
+        stop = threading.Event()
+
+        def produce() -> None:
+            """Put commits in the queue, followed by None."""
+            try:
+                for object_content in read_objects():
+                    if stop.is_set():
+                        break
+                    commits.put(to_commit(object_content))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                diff_batch.close()
+                commits.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                commit = commits.get()
+                if commit is None:
+                    break
+                yield commit
+            if errors:
+                raise errors[0]
+        finally:
+            # Unblock and wait for the producer when the iteration stops
+            # before the end of the log
+            stop.set()
+            while producer.is_alive():
+                try:
+                    commits.get(timeout=0.1)
+                except queue.Empty:
+                    pass
 
     def rev_parse(self, refspec: str = HEAD) -> str:
         """Get the sha associated to a given refspec.
 
+        Results are cached until the next git command is run through this
+        object, so changes done to the repository by other means in the
+        meantime are not seen.
+
         :param refspec: refspec.
         :raise: GitError
         """
-        p = self.git_cmd(["rev-parse", "--revs-only", refspec], output=PIPE, error=PIPE)
-        return p.out.strip()  # type: ignore
+        if _SHA1_RE.fullmatch(refspec):
+            # git rev-parse returns full sha1 unchanged
+            return refspec
+        result = self._rev_cache.get(refspec)
+        if result is not None:
+            return result
+
+        repo = self._libgit2
+        if repo is not None:
+            try:
+                result = str(repo.revparse_single(refspec).id)
+            except (KeyError, ValueError, pygit2.GitError):
+                # Let git handle refspecs not supported by libgit2
+                pass
+
+        if result is None:
+            # rev-parse is read-only, keep the other cached results
+            p = self._run_git(
+                ["rev-parse", "--revs-only", refspec], output=PIPE, error=PIPE
+            )
+            result = p.out.strip()  # type: ignore
+        self._rev_cache[refspec] = result
+        return result
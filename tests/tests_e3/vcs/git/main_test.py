@@ -1,6 +1,9 @@
+import io
 import os
 import subprocess
+import threading
 
+import e3.vcs.git
 from e3.fs import echo_to_file, rm
 from e3.os.fs import unixpath
 from e3.vcs.git import GitError, GitRepository
@@ -10,6 +13,15 @@ import tempfile
 from contextlib import closing
 
 
+@pytest.fixture(autouse=True, params=["pygit2", "git"])
+def git_backend(request, monkeypatch):
+    """Run the tests both with and without pygit2."""
+    if request.param == "git":
+        monkeypatch.setattr(e3.vcs.git, "has_pygit2", False)
+    elif not e3.vcs.git.has_pygit2:
+        pytest.skip("pygit2 not available")
+
+
 @pytest.mark.git
 def test_git_non_utf8():
     """Test with non utf-8 encoding in changelog."""
@@ -40,7 +52,8 @@ def test_git_non_utf8():
     finally:
         rm(tmp_filename)
 
-    assert "\\x03\\xff" in commits[0]["diff"]
+    # Invalid utf-8 bytes are escaped
+    assert "+\x03\\xff" in commits[0]["diff"]
 
 
 @pytest.mark.git
@@ -89,6 +102,29 @@ def test_git_repo():
         commits = list(repo.parse_log(f))
         assert commits[0]["notes"] is None
 
+    # lines not following the "key: value" format are ignored
+    repo.git_cmd(
+        [
+            "notes",
+            "--ref",
+            "review",
+            "add",
+            "HEAD",
+            "-f",
+            "-m",
+            "invalid-note\nSubmitted-by: Nobody <nobody@example.com>",
+        ]
+    )
+    with open("log.txt", "w") as f:
+        repo.write_log(f, with_gerrit_notes=True)
+    with open("log.txt") as f:
+        commits = list(repo.parse_log(f))
+        assert commits[0]["notes"] == {"Submitted-by": "Nobody <nobody@example.com>"}
+
+    repo.git_cmd(
+        ["notes", "--ref", "review", "add", "HEAD", "-f", "-m", "invalid-note"]
+    )
+
     # try again without gerrit notes
     with open("log.txt", "w") as f:
         repo.write_log(f)
@@ -138,3 +174,224 @@ def test_git_repo():
         ["notes", "--ref=review", "show", new_sha], output=subprocess.PIPE
     )
     assert "invalid-note" in p.out
+
+
+@pytest.mark.git
+def test_git_log_diff(monkeypatch):
+    """Check diffs returned by parse_log, including merge commits."""
+    working_tree = os.path.join(os.getcwd(), "working_tree")
+    repo = GitRepository(working_tree)
+    repo.init()
+    os.chdir(working_tree)
+    repo.git_cmd(["config", "user.email", "e3-core@example.net"])
+    repo.git_cmd(["config", "user.name", "e3 core"])
+
+    echo_to_file("a.txt", "a\n")
+    repo.git_cmd(["add", "a.txt"])
+    repo.git_cmd(["commit", "-m", "add a"])
+    repo.git_cmd(["checkout", "-q", "-b", "side"])
+    echo_to_file("b.txt", "b\n")
+    repo.git_cmd(["add", "b.txt"])
+    repo.git_cmd(["commit", "-m", "add b"])
+    repo.git_cmd(["checkout", "-q", "-"])
+    echo_to_file("a.txt", "a\nc\n")
+    repo.git_cmd(["commit", "-a", "-m", "update a"])
+    repo.git_cmd(["merge", "--no-edit", "side"])
+
+    with open("log.txt", "w") as f:
+        repo.write_log(f)
+    with open("log.txt") as f:
+        commits = list(repo.parse_log(f, max_diff_size=4096))
+
+    assert len(commits) == 4
+    for commit in commits:
+        with open("commit.diff", "wb") as f:
+            repo.write_diff(f, commit["sha"])
+        with open("commit.diff", "rb") as f:
+            assert commit["diff"] == f.read().decode("utf-8")
+
+    # Lines longer than the read chunks, including a chunk matching the
+    # sentinel in the middle of a line
+    with monkeypatch.context() as m:
+        m.setattr(e3.vcs.git, "_LOG_CHUNK_SIZE", 12)
+        echo_to_file("c.txt", "abcdefghijke3-diff-end\n")
+        repo.git_cmd(["add", "c.txt"])
+        repo.git_cmd(["commit", "-m", "add c"])
+        with open("log.txt", "w") as f:
+            repo.write_log(f, max_count=1)
+        with open("log.txt") as f:
+            (long_line_commit,) = list(repo.parse_log(f, max_diff_size=4096))
+        assert "+abcdefghijke3-diff-end\n" in long_line_commit["diff"]
+    repo.git_cmd(["reset", "-q", "--hard", "HEAD~1"])
+
+    # The merge commit has no conflict so its combined diff is empty
+    assert commits[0]["diff"] == ""
+    assert any("+b" in commit["diff"] for commit in commits)
+    assert any("+c" in commit["diff"] for commit in commits)
+
+    # The log can also be parsed while git log is running
+    assert list(repo.iter_log(max_diff_size=4096)) == commits
+    assert len(list(repo.iter_log(max_count=1))) == 1
+    assert [c["message"] for c in repo.iter_log(max_message_size=4)] == [
+        c["message"][:4] + "\n... message too long ...\n" for c in commits
+    ]
+    for commit in repo.iter_log():
+        assert commit["sha"] == commits[0]["sha"]
+        break
+
+    # Diffs are computed in a separate thread, check that it is stopped
+    # when the iteration ends early
+    thread_count = threading.active_count()
+    for commit in repo.iter_log(max_diff_size=4096):
+        assert commit == commits[0]
+        break
+    assert threading.active_count() == thread_count
+
+    with pytest.raises(GitError) as err:
+        list(repo.iter_log(rev_range="unknown-rev"))
+    assert "unknown-rev" in str(err)
+
+
+@pytest.mark.git
+def test_git_parse_log_streams(monkeypatch):
+    """Parse logs containing non-ascii characters from various streams."""
+    working_tree = os.path.join(os.getcwd(), "working_tree")
+    repo = GitRepository(working_tree)
+    repo.init()
+    os.chdir(working_tree)
+    repo.git_cmd(["config", "user.email", "e3-core@example.net"])
+    repo.git_cmd(["config", "user.name", "e3 core"])
+    for name in ("a", "b", "c"):
+        echo_to_file(f"{name}.txt", "\u00e9t\u00e9\n")
+        repo.git_cmd(["add", f"{name}.txt"])
+        repo.git_cmd(["commit", "-m", f"\u00e9t\u00e9 {name}"])
+
+    with open("log.txt", "w") as f:
+        repo.write_log(f)
+    with open("log.txt", "rb") as f:
+        content = f.read()
+    with open("log.txt") as f:
+        commits = list(repo.parse_log(f))
+
+    assert [c["message"] for c in commits] == [
+        "\u00e9t\u00e9 c\n",
+        "\u00e9t\u00e9 b\n",
+        "\u00e9t\u00e9 a\n",
+    ]
+    assert list(repo.parse_log(io.BytesIO(content))) == commits
+    assert list(repo.parse_log(io.StringIO(content.decode("utf-8")))) == commits
+
+    # Messages are truncated to a number of bytes, without splitting a
+    # character
+    assert [c["message"] for c in repo.parse_log(io.BytesIO(content), 0, 4)] == [
+        "\u00e9t\n... message too long ...\n"
+    ] * 3
+    assert [c["message"] for c in repo.parse_log(io.BytesIO(content), 0, 5)] == [
+        "\u00e9t\u00e9\n... message too long ...\n"
+    ] * 3
+
+    # NUL separated logs are also supported
+    p = repo.git_cmd(
+        ["log", "-z", "--format=format:%H%n%aE%n%ci%n%n%B"], output=subprocess.PIPE
+    )
+    assert list(repo.parse_log(io.BytesIO(p.raw_out))) == commits
+    assert list(repo.parse_log(io.BytesIO(b""))) == []
+
+    # Commits spanning several chunks
+    monkeypatch.setattr(e3.vcs.git, "_LOG_CHUNK_SIZE", 5)
+    assert list(repo.parse_log(io.BytesIO(content))) == commits
+    assert list(repo.parse_log(io.BytesIO(p.raw_out))) == commits
+
+
+@pytest.mark.git
+def test_git_fetch_cache():
+    """Check that fetch can skip refspecs already fetched."""
+    working_tree = os.path.join(os.getcwd(), "working_tree")
+    working_tree2 = os.path.join(os.getcwd(), "working_tree2")
+    repo = GitRepository(working_tree)
+    repo.init()
+    repo.git_cmd(["config", "user.email", "e3-core@example.net"])
+    repo.git_cmd(["config", "user.name", "e3 core"])
+    repo.git_cmd(["commit", "--allow-empty", "-m", "first"])
+    first_sha = repo.rev_parse()
+
+    repo2 = GitRepository(working_tree2)
+    giturl = "file://%s" % working_tree.replace("\\", "/")
+    repo2.init(url=giturl)
+    repo2.fetch(giturl, "master", use_cache=True)
+    assert repo2.rev_parse("FETCH_HEAD") == first_sha
+
+    repo.git_cmd(["commit", "--allow-empty", "-m", "second"])
+    second_sha = repo.rev_parse()
+
+    # The remote change is ignored when using the cache
+    repo2.fetch(giturl, "master", use_cache=True)
+    assert repo2.rev_parse("FETCH_HEAD") == first_sha
+
+    repo2.fetch(giturl, "master")
+    assert repo2.rev_parse("FETCH_HEAD") == second_sha
+
+    repo2.update(giturl, "master", probe=True)
+    assert repo2.rev_parse() == second_sha
+
+    repo2.update(giturl, "+master:refs/remotes/origin/master", probe=True)
+    assert repo2.rev_parse("refs/remotes/origin/master") == second_sha
+
+    with pytest.raises(GitError) as err:
+        repo2.update(giturl, "unknown-branch", probe=True)
+    assert "ls-remote" in str(err)
+
+
+@pytest.mark.git
+def test_git_rev_parse_cache(monkeypatch):
+    """Check that rev_parse results are cached until the next git command."""
+    working_tree = os.path.join(os.getcwd(), "working_tree")
+    repo = GitRepository(working_tree)
+    repo.init()
+    repo.git_cmd(["config", "user.email", "e3-core@example.net"])
+    repo.git_cmd(["config", "user.name", "e3 core"])
+    repo.git_cmd(["commit", "--allow-empty", "-m", "first"])
+    first_sha = repo.rev_parse()
+
+    # Full sha1 are returned without checking that they exist
+    assert repo.rev_parse(first_sha) == first_sha
+    assert repo.rev_parse(40 * "0") == 40 * "0"
+
+    # A change done by another object is not seen...
+    GitRepository(working_tree).git_cmd(["commit", "--allow-empty", "-m", "second"])
+    assert repo.rev_parse() == first_sha
+
+    # ... until a git command is run
+    repo.git_cmd(["status"])
+    second_sha = repo.rev_parse()
+    assert second_sha != first_sha
+    assert repo.rev_parse("HEAD~1") == first_sha
+
+    # Looking up a refspec does not discard the other cached results
+    calls = []
+    run = e3.os.process.Run
+
+    def counting_run(cmd, *args, **kwargs):
+        calls.append(cmd)
+        return run(cmd, *args, **kwargs)
+
+    monkeypatch.setattr(e3.os.process, "Run", counting_run)
+    for _ in range(5):
+        assert repo.rev_parse() == second_sha
+        assert repo.rev_parse("HEAD~1") == first_sha
+    assert calls == []
+
+
+@pytest.mark.git
+def test_git_binary(monkeypatch):
+    """Check that the git class attribute selects the git binary."""
+    repo = GitRepository(os.path.join(os.getcwd(), "working_tree"))
+    with monkeypatch.context() as m:
+        m.setattr(GitRepository, "git", "/non/existing/git")
+        with pytest.raises(OSError):
+            repo.init()
+    repo.init()
+
+    with pytest.raises(GitError) as err:
+        repo.git_cmd(["log", None])
+    assert "invalid git command line" in str(err)